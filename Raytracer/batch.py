@@ -0,0 +1,131 @@
+"""
+    batch.py
+
+    Headless batch rendering, no GLFW window needed. Renders a turntable of
+    rotate_pos steps, or the given camera poses, to numbered PNG files, e.g.
+
+        python3 batch.py --frames 20 --output turntable/frame_%04d.png
+        python3 batch.py --poses 0 5 -5 --pitch 1 --parallel 3
+        python3 batch.py --cameras flight.txt
+
+    A pose orbits the camera (the default one, or --eye, --target and --fov)
+    by that many rotate_pos steps (negative: rotate_neg steps) and --pitch
+    steps upwards, the scene stays as it is. A --cameras file lists explicit
+    cameras instead, one per line: eye x y z, target x y z and optionally the
+    field of view in degrees, e.g. "0 .35 -1  0 .05 2  60". # starts a comment.
+"""
+
+import argparse
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import util
+
+from PIL import Image
+import rt3 as rt
+from raytracerTemplate import RayTracer
+
+# ray tracer of this process
+ray_tracer = None
+
+
+def init_frames(objects, dtype, settings):
+    global ray_tracer
+    # pool processes skip atexit, free the framebuffer when the process ends
+    util.Finalize(None, rt.release_framebuffer, exitpriority=0)
+    rt.load_scene(objects)
+    rt.set_precision(dtype)
+    # every frame has its own camera, a G-buffer would never be reused
+    ray_tracer = RayTracer(**settings, progressive=False, gbuffer=False)
+
+
+def render_frame(camera, path):
+    # Renders the frame of the camera and saves it
+    ray_tracer.camera = camera
+    Image.fromarray(ray_tracer.render()).save(path)
+    return path
+
+
+def read_cameras(path, fov):
+    # Cameras of a --cameras file, fov unless a line gives its own
+    cameras = []
+    with open(path) as file:
+        for line in file:
+            values = [float(v) for v in line.split("#")[0].split()]
+            if not values:
+                continue
+            if len(values) not in (6, 7):
+                raise ValueError("%s: expected eye x y z, target x y z [fov], got %r" % (path, line.strip()))
+            cameras.append(rt.Camera(rt.vec3(*values[:3]), rt.vec3(*values[3:6]),
+                                     fov=values[6] if len(values) == 7 else fov))
+    return cameras
+
+
+# main function
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Render rotation sequences to PNG files without a window")
+    parser.add_argument("models", nargs="*", help="OBJ models to add, e.g. ../OpenGL_Mesh_Viewer/models/bunny.obj")
+    parser.add_argument("--frames", type=int, default=20, help="turntable frames, one rotate_pos step apart")
+    parser.add_argument("--poses", type=float, nargs="+", help="rotation steps of the frames, instead of --frames")
+    parser.add_argument("--pitch", type=float, default=0, help="steps the camera looks down from above")
+    parser.add_argument("--eye", type=float, nargs=3, metavar=("X", "Y", "Z"),
+                        help="camera position the poses orbit from, instead of the default camera's")
+    parser.add_argument("--target", type=float, nargs=3, metavar=("X", "Y", "Z"),
+                        help="point the camera looks at and orbits around")
+    parser.add_argument("--fov", type=float, help="horizontal field of view in degrees")
+    parser.add_argument("--cameras", metavar="FILE",
+                        help="file of explicit cameras (eye, target, fov per line), instead of poses")
+    parser.add_argument("--output", default="frames/frame_%04d.png", help="file name pattern of the frames")
+    parser.add_argument("--size", default="640x480", metavar="WxH")
+    parser.add_argument("--parallel", type=int, default=1, help="number of frames rendered at once in processes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of tile rendering processes per frame, ignored with --parallel")
+    parser.add_argument("--max-bounce", type=int, default=rt.MAX_BOUNCE,
+                        help="maximum reflection depth, rays below rt3.MIN_WEIGHT stop earlier")
+    parser.add_argument("--antialias", type=int, default=0, metavar="SAMPLES",
+                        help="extra jittered samples for edge pixels")
+    parser.add_argument("--float32", action="store_true", help="trace in single instead of double precision")
+    parser.add_argument("--memory", type=int, default=rt.MEMORY_BUDGET >> 20, metavar="MB",
+                        help="memory budget of the rays traced at once, large frames render in bands")
+    args = parser.parse_args()
+
+    # optionally add OBJ models given on the command line
+    for path in args.models:
+        rt.add_model(path)
+    if args.float32:
+        rt.set_precision("float32")
+
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    settings = dict(width=width, height=height, workers=args.workers,
+                    max_bounce=args.max_bounce, antialias=args.antialias, memory=args.memory << 20)
+    # the cameras of the frames: explicit ones or orbits of the base camera
+    base = rt.default_camera()
+    if args.eye is not None:
+        base.eye = rt.vec3(*args.eye)
+    if args.target is not None:
+        base.target = rt.vec3(*args.target)
+    if args.fov is not None:
+        base.fov = args.fov
+    if args.cameras:
+        cameras = read_cameras(args.cameras, base.fov)
+    else:
+        poses = args.poses if args.poses is not None else range(args.frames)
+        cameras = [copy.deepcopy(base).orbit(pose * RayTracer.STEP, args.pitch * RayTracer.STEP) for pose in poses]
+    paths = [args.output % i for i in range(len(cameras))]
+    for directory in {os.path.dirname(path) for path in paths} - {""}:
+        os.makedirs(directory, exist_ok=True)
+
+    if args.parallel > 1:
+        # every process gets the scene once and then only the cameras of its
+        # frames. The frames keep the cores busy, a frame process renders
+        # without tile pool, whose processes would outlive it and block its exit
+        settings["workers"] = 1
+        with ProcessPoolExecutor(args.parallel, initializer=init_frames,
+                                 initargs=(list(rt.scene), rt.vec3.dtype, settings)) as executor:
+            for path in executor.map(render_frame, cameras, paths):
+                print("Saved", path)
+    else:
+        init_frames(list(rt.scene), rt.vec3.dtype, settings)
+        for (camera, path) in zip(cameras, paths):
+            print("Saved", render_frame(camera, path))
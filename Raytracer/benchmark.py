@@ -0,0 +1,157 @@
+"""
+    benchmark.py
+
+    Headless ray tracer benchmark, no GLFW window needed. Renders a set of
+    scenes at several resolutions and prints wall time, primary/secondary
+    rays per second and peak memory as JSON, e.g.
+
+        python3 benchmark.py --sizes 320x240 640x480 --output results.json
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import rt3 as rt
+
+MODELS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "OpenGL_Mesh_Viewer", "models")
+
+# rt.load_scene replaces the objects of rt.scene and rt.set_precision converts
+# them, keep the original ones and hand out copies
+REFERENCE = copy.deepcopy(rt.scene)
+
+
+def reference_scene():
+    return copy.deepcopy(REFERENCE), {}
+
+
+def random_spheres(count, seed=0):
+    # count small spheres scattered above the checkered plane
+    rng = np.random.default_rng(seed)
+    objects = [rt.Plane(rt.vec3(0, -.5, 0), rt.vec3(0, 1, 0), rt.vec3(1, 1, 1))]
+    for (c, r, color) in zip(rng.uniform((-2, -.4, 1), (2, 1.6, 5), (count, 3)),
+                             rng.uniform(.02, .15, count),
+                             rng.uniform(0, 1, (count, 3))):
+        objects.append(rt.Sphere(rt.vec3(*c), r, rt.vec3(*color)))
+    return objects, {}
+
+
+def bunny_scene():
+    bunny = rt.TriangleMesh.from_obj(os.path.join(MODELS, "bunny.obj"), rt.vec3(.9, .9, .9),
+                                     center=rt.vec3(0, .1, 1.5), size=1.2)
+    return [rt.Plane(rt.vec3(0, -.5, 0), rt.vec3(0, 1, 0), rt.vec3(1, 1, 1)), bunny], {}
+
+
+def deep_reflections():
+    # the reference scene, every reflection traced to depth 8
+    return copy.deepcopy(REFERENCE), {"max_bounce": 8, "min_weight": 0}
+
+
+SCENES = {
+    "reference":        reference_scene,
+    "spheres_100":      lambda: random_spheres(100),
+    "spheres_1000":     lambda: random_spheres(1000),
+    "bunny":            bunny_scene,
+    "deep_reflections": deep_reflections,
+}
+
+
+def render(width, height, workers, options):
+    # one frame traced in full, the "Took" output of main_scene is swallowed
+    with contextlib.redirect_stdout(io.StringIO()):
+        return rt.main_scene(SimpleNamespace(), width, height, workers=workers, gbuffer=False, **options).copy()
+
+
+def run(name, width, height, repeat, workers, precision):
+    # Returns the result and the image of the last frame
+    objects, options = SCENES[name]()
+    rt.load_scene(objects)
+    rt.set_precision(precision)
+
+    # best wall time of repeat frames, rays counted for the last one
+    times = []
+    for _ in range(repeat):
+        rt.reset_stats()
+        t0 = time.perf_counter()
+        image = render(width, height, workers, options)
+        times.append(time.perf_counter() - t0)
+    rays = dict(rt.stats)
+    stages = {stage: seconds for (stage, (count, seconds)) in rt.profile().items()}
+    seconds = min(times)
+
+    # peak memory of a separate frame, tracemalloc slows rendering down
+    tracemalloc.start()
+    render(width, height, workers, options)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    secondary = rays["shadow_rays"] + rays["reflection_rays"]
+    return {
+        "scene":                        name,
+        "width":                        width,
+        "height":                       height,
+        "workers":                      workers,
+        "precision":                    precision,
+        "seconds":                      seconds,
+        "primary_rays":                 rays["primary_rays"],
+        "secondary_rays":               secondary,
+        "shadow_rays":                  rays["shadow_rays"],
+        "reflection_rays":              rays["reflection_rays"],
+        "primary_rays_per_second":      rays["primary_rays"] / seconds,
+        "secondary_rays_per_second":    secondary / seconds,
+        "rays_per_second":              (rays["primary_rays"] + secondary) / seconds,
+        "peak_memory_bytes":            peak,
+        "stage_seconds":                stages,
+    }, image
+
+
+def difference(image, reference):
+    # how far an 8-bit image is off the reference
+    d = np.abs(image.astype(int) - reference).max(axis=2)
+    return {"max_difference": int(d.max()), "mean_difference": float(d.mean()),
+            "differing_pixels": float((d > 1).mean())}
+
+
+def size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+# main function
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Headless rt3 benchmark, results as JSON")
+    parser.add_argument("--scenes", nargs="+", choices=sorted(SCENES), default=list(SCENES))
+    parser.add_argument("--sizes", nargs="+", type=size, default=[(160, 120), (320, 240), (640, 480)],
+                        metavar="WxH")
+    parser.add_argument("--repeat", type=int, default=3, help="frames per run, the fastest counts")
+    parser.add_argument("--workers", type=int, default=1, help="number of tile rendering processes")
+    parser.add_argument("--precision", nargs="+", choices=["float64", "float32"], default=["float64"],
+                        help="float types to render with, others are compared to the float64 image")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenes:
+        for (width, height) in args.sizes:
+            images = {}
+            for precision in args.precision:
+                (result, images[precision]) = run(name, width, height, args.repeat, args.workers, precision)
+                results.append(result)
+            if "float64" in images:
+                for result in results[-len(images):]:
+                    result.update(difference(images[result["precision"]], images["float64"]))
+
+    report = json.dumps({"results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
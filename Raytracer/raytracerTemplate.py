@@ -31,45 +31,164 @@
  ****
 """
 
-from rendering import Scene, RenderWindow
 import numpy as np
+import argparse
+import time
+from collections import deque
 import rt3 as rt
 
 
 class RayTracer:
 
-    def __init__(self, width, height):
+    # pixel steps of the progressive refinement levels, coarse to full resolution
+    LEVELS = (8, 4, 2, 1)
+
+    # camera orbit angle of rotate_pos and rotate_neg
+    STEP = np.pi / 10
+
+    # smallest render scale of the frame budget mode, below it reflections are cut
+    MIN_SCALE = .25
+
+    def __init__(self, width, height, workers=1, progressive=True, max_bounce=rt.MAX_BOUNCE, antialias=0,
+                 memory=rt.MEMORY_BUDGET, gbuffer=True, frame_budget=None):
         self.width  = width
         self.height = height
-
-        # TODO: setup your ray tracer
+        self.workers = workers      # > 1 renders tiles in a process pool
+        self.progressive = progressive
+        self.max_bounce = max_bounce    # reflection depth, faint rays stop earlier
+        self.antialias = antialias      # extra samples for edge pixels, 0 = off
+        self.memory = memory            # bytes the rays traced at once may take
+        self.gbuffer = gbuffer          # keep first hits, light changes skip primary rays
+        self.camera = rt.default_camera()   # moving it leaves the scene as is
+        self.level  = 0             # next refinement level to render
+        self.frame_budget = frame_budget    # seconds a full resolution frame may take, None = off
+        self.scale  = 1.0           # render resolution relative to width x height
+        self.bounce = max_bounce    # reflection depth within the frame budget
+        self.frame_times = deque(maxlen=4)  # seconds of the last full resolution frames
 
     def resize(self, new_width, new_height):
         self.width  = new_width
         self.height = new_height
+        self.level  = 0
+
+    def orbit(self, yaw, pitch=0):
+        self.camera.orbit(yaw, pitch)
+        self.level = 0
+
+    def light(self):
+        return rt.L.array()
+
+    def move_light(self, x, y, z):
+        rt.L = rt.vec3(x, y, z)
+        self.level = 0
 
     def rotate_pos(self):
-        rt.main_scene(self, self.width, self.height, p=True)
+        self.orbit(self.STEP)
 
     def rotate_neg(self):
-        rt.main_scene(self, self.width, self.height, n=True)
-
-    def render(self):
-        return rt.main_scene(self, self.width, self.height)
+        self.orbit(-self.STEP)
+
+    def profile(self):
+        # {stage: (count, seconds)} of rt3, see rt.STAGES
+        return rt.profile()
+
+    def reset_profile(self):
+        rt.reset_stats()
+
+    def close(self):
+        # stops the tile rendering processes
+        rt.release_pool()
+
+    def converged(self):
+        return not self.progressive or self.level == len(self.LEVELS)
+
+    def adapt(self):
+        # Frame budget mode: moves the render scale towards the budget, by the
+        # mean time of the last full resolution frames, and at MIN_SCALE the
+        # reflection depth. Raising them again goes the other way round
+        if self.frame_budget is None or not self.frame_times:
+            return
+        seconds = sum(self.frame_times) / len(self.frame_times)
+        if .8 * self.frame_budget <= seconds <= 1.25 * self.frame_budget:
+            return
+        # the time goes with the pixel count, scales are multiples of 1/8
+        target = self.scale * np.sqrt(self.frame_budget / seconds)
+        scale = min(1.0, max(self.MIN_SCALE, float(np.floor(8 * target)) / 8))
+        if seconds > self.frame_budget:
+            if self.scale > self.MIN_SCALE:
+                self.scale = scale
+            elif self.bounce > 1:
+                self.bounce -= 1
+        elif self.bounce < self.max_bounce:
+            self.bounce += 1
+        elif scale > self.scale:
+            self.scale = scale
+        self.frame_times.clear()
+
+    def render_size(self):
+        return (max(1, round(self.width * self.scale)), max(1, round(self.height * self.scale)))
+
+    def render(self, regions=None):
+        # regions(image, box) is called with every part of the image done, see
+        # rt3.main_scene. Progressive calls refine the previous image, reusing
+        # its samples, so the frame budget only changes the size (the image may
+        # be smaller than width x height) and depth when they start over
+        if self.converged():
+            self.level = 0
+        if self.level == 0:
+            self.adapt()
+        step = self.LEVELS[self.level] if self.progressive else 1
+        (width, height) = self.render_size()
+
+        t0 = time.perf_counter()
+        image = rt.main_scene(self, width, height, self.camera, workers=self.workers,
+                              step=step, refine=self.level > 0,
+                              antialias=self.antialias, max_bounce=self.bounce, memory=self.memory,
+                              gbuffer=self.gbuffer, regions=regions)
+        if step == 1:
+            self.frame_times.append(time.perf_counter() - t0)
+        if self.progressive:
+            self.level += 1
+        return image
 
 
 
 # main function
 if __name__ == '__main__':
 
+    # the window is only needed here, batch.py uses RayTracer headless
+    from rendering import Scene, RenderWindow
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", nargs="*", help="OBJ models to add, e.g. ../OpenGL_Mesh_Viewer/models/bunny.obj")
+    parser.add_argument("--workers", type=int, default=1, help="number of tile rendering processes")
+    parser.add_argument("--no-progressive", dest="progressive", action="store_false",
+                        help="render full resolution frames only, no coarse previews")
+    parser.add_argument("--max-bounce", type=int, default=rt.MAX_BOUNCE,
+                        help="maximum reflection depth, rays below rt3.MIN_WEIGHT stop earlier")
+    parser.add_argument("--antialias", type=int, default=0, metavar="SAMPLES",
+                        help="extra jittered samples for edge pixels of full resolution frames")
+    parser.add_argument("--float32", action="store_true", help="trace in single instead of double precision")
+    parser.add_argument("--pbo", action="store_true", help="upload the finished tiles through a pixel buffer object")
+    parser.add_argument("--frame-budget", type=float, metavar="MS",
+                        help="scale the resolution and reflection depth so that a full frame takes about MS")
+    args = parser.parse_args()
+
     # set size of render viewport
     width, height = 640, 480
 
+    # optionally add OBJ models given on the command line
+    for path in args.models:
+        rt.add_model(path)
+    if args.float32:
+        rt.set_precision("float32")
+
     # instantiate a ray tracer
-    ray_tracer = RayTracer(width, height)
+    ray_tracer = RayTracer(width, height, args.workers, args.progressive, args.max_bounce, args.antialias,
+                           frame_budget=args.frame_budget / 1000 if args.frame_budget else None)
 
     # instantiate a scene
-    scene = Scene(width, height, ray_tracer, "Raytracing Template")
+    scene = Scene(width, height, ray_tracer, "Raytracing Template", use_pbo=args.pbo)
 
     # pass the scene to a render window
     rw = RenderWindow(scene)
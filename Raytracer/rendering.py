@@ -28,13 +28,138 @@
 
 import glfw
 import imgui
+import inspect
 import numpy as np
 import moderngl as mgl
 import os
+import threading
+import traceback
 
 from imgui.integrations.glfw import GlfwRenderer
 
 
+class BackgroundRenderer:
+    """
+        Runs ray_tracer.render() on a worker thread and publishes finished frames.
+        Ray tracer calls that change the image (rotations, resizes) are queued as
+        actions and run on that thread too. A new request supersedes the frame in
+        flight: it is dropped when done and the newest request is rendered instead.
+        Ray tracers with a converged() method that returns False are rendered
+        again once their frame was uploaded, refining the image frame by frame.
+        Ray tracers whose render() takes a regions callback report the parts of
+        the image done while rendering; those are uploaded right away and only
+        the dirty rest of the frame is uploaded when it is finished.
+        Exceptions of actions or render() are printed and the request is
+        dropped, the thread keeps serving the next ones.
+    """
+    def __init__(self, ray_tracer):
+        self.ray_tracer = ray_tracer
+        self.partial    = "regions" in inspect.signature(ray_tracer.render).parameters
+        self.cond       = threading.Condition()
+        self.actions    = []        # pending ray tracer calls
+        self.requested  = 0         # generation of the newest request
+        self.frame      = None      # finished image waiting for upload
+        self.live       = None      # image being rendered
+        self.dirty      = []        # its (x0, y0, x1, y1) boxes done but not uploaded
+        self.refining   = False     # last frame was not the final one
+        self.closed     = False
+        self.notify     = None      # called on the render thread when something can be uploaded
+        self.thread     = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+
+    def request(self, *actions):
+        with self.cond:
+            self.actions.extend(actions)
+            self.requested += 1
+            self.frame = None       # superseded, the renderer may reuse its buffer
+            self.live  = None
+            self.dirty = []
+            self.cond.notify_all()
+
+
+    def finished(self, generation, image, box):
+        # regions callback of the render thread
+        with self.cond:
+            if generation == self.requested:
+                self.live = image
+                self.dirty.append(box)
+                if self.notify is not None:
+                    self.notify()
+
+
+    def loop(self):
+        done = 0
+        while True:
+            with self.cond:
+                # wait for a new request or refinement and until the last frame was picked up
+                while not self.closed and ((self.requested == done and not self.refining) or self.frame is not None):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                actions, self.actions = self.actions, []
+                generation = self.requested
+
+            try:
+                for action in actions:
+                    action()
+                if self.partial:
+                    image = self.ray_tracer.render(regions=lambda image, box: self.finished(generation, image, box))
+                else:
+                    image = self.ray_tracer.render()
+            except Exception:
+                traceback.print_exc()
+                image = None
+
+            with self.cond:
+                done = generation
+                if image is None:
+                    self.refining = False   # no retries of a failing refinement
+                    continue
+                if generation == self.requested:
+                    self.frame = image
+                    if self.notify is not None:
+                        self.notify()
+                converged = getattr(self.ray_tracer, "converged", None)
+                self.refining = converged is not None and not converged()
+
+
+    def ready(self):
+        # whether upload() has anything to write
+        with self.cond:
+            return self.frame is not None or bool(self.dirty)
+
+
+    def upload(self, write):
+        """
+        Passes a finished frame or the boxes of the frame in flight done so far
+        to write(image, boxes) on the calling thread, boxes is None if all of
+        the image changed. The frame is not touched by the render thread until
+        write() returned, nor are the boxes until the next frame is requested.
+        """
+        with self.cond:
+            if self.frame is not None:
+                write(self.frame, self.dirty if self.partial else None)
+                self.frame = None
+                self.live  = None
+                self.dirty = []
+                self.cond.notify_all()
+                return True
+            if self.dirty:
+                write(self.live, self.dirty)
+                self.dirty = []
+                return True
+            return False
+
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+
 class Scene:
     """
         OpenGL 2D scene class
@@ -44,7 +169,8 @@ class Scene:
                 width,
                 height,
                 ray_tracer,
-                scene_title         = "2D Scene"):
+                scene_title         = "2D Scene",
+                use_pbo             = False):
 
         self.width              = width
         self.height             = height
@@ -53,6 +179,9 @@ class Scene:
         # Scene specific
         self.ray_tracer         = ray_tracer
         self.gl_texture         = None
+        self.use_pbo            = use_pbo           # stage texture uploads in a pixel buffer object
+        self.pbo                = None
+        self.background         = BackgroundRenderer(ray_tracer)
 
         # Rendering
         self.ctx                = None              # Assigned when calling init_gl()
@@ -130,21 +259,37 @@ class Scene:
         self.vao        = self.ctx.vertex_array(self.shader, [(vbo, '2f 2f', *'vert tex_coords'.split())])
 
 
-    def initialize_gl_texture(self):
+    def initialize_gl_texture(self, width=None, height=None):
         """
         Creates a moderngl texture object. Note that a 1Byte-RGB data format is used.
+        It has the size of the window unless given another one, it is stretched
+        over the window anyway.
         """
+        width               = self.width if width is None else width
+        height              = self.height if height is None else height
 
-        # Release previous Texture (i.e. after resize)
+        # Start from the previous Texture (i.e. after resize) scaled to the new
+        # size, until the ray tracer has drawn over it, and release it
+        image_data          = np.zeros((height, width, 3), dtype=np.uint8)
         if self.gl_texture is not None:
+            (w, h)          = self.gl_texture.size
+            previous        = np.frombuffer(self.gl_texture.read(alignment=1), dtype=np.uint8).reshape(h, w, 3)
+            image_data      = previous[np.arange(height) * h // height][:, np.arange(width) * w // width]
+            image_data      = np.ascontiguousarray(image_data)
             self.gl_texture.release()
 
-        image_data          = np.zeros((self.height, self.width, 3), dtype=np.uint8)
-        gl_texture          = self.ctx.texture((self.width, self.height), components=3, data=image_data, dtype='u1')
+        gl_texture          = self.ctx.texture((width, height), components=3, data=image_data, dtype='u1')
         gl_texture.repeat_x = False
         gl_texture.repeat_y = False
         self.gl_texture     = gl_texture
 
+        # Pixel buffer object the uploads go through, large enough for a full frame
+        if self.pbo is not None:
+            self.pbo.release()
+            self.pbo = None
+        if self.use_pbo:
+            self.pbo = self.ctx.buffer(reserve=width * height * 3)
+
 
 
     def resize(self, width, height):
@@ -155,25 +300,76 @@ class Scene:
         self.initialize_gl_texture()
 
         # Ask ray tracer to resize
-        self.ray_tracer.resize(width, height)
+        self.update_ray_tracer_image(lambda: self.ray_tracer.resize(width, height))
 
-        self.update_ray_tracer_image()
 
+    def update_ray_tracer_image(self, *actions):
+        """
+        Requests a new image from the ray tracer, rendered in the background after
+        running actions (e.g. ray_tracer.rotate_pos) on the render thread.
+        """
+        self.background.request(*actions)
 
-    def update_ray_tracer_image(self):
 
-        # Get Image fram Ray Tracer and write it to the GPU
-        image = self.ray_tracer.render()
+    def upload_ray_tracer_image(self, image, boxes=None):
+        """
+        Writes the (x0, y0, x1, y1) boxes of the top-down image to the texture,
+        all of it if boxes is None or they would cover as many pixels anyway.
+        Frames of outdated sizes never get here (see BackgroundRenderer), but ray
+        tracers with a frame budget render below the window size: the texture
+        takes the size of the image and is upscaled when drawn. Resized, it
+        starts as the last frame scaled, which the boxes are drawn over.
+        """
+        (height, width) = image.shape[:2]
+        if self.gl_texture.size != (width, height):
+            self.initialize_gl_texture(width, height)
+
+        if boxes is None or sum((x1 - x0) * (y1 - y0) for (x0, y0, x1, y1) in boxes) >= width * height:
+            boxes = [(0, 0, width, height)]
+
+        for (x0, y0, x1, y1) in boxes:
+            # Flip y-axis (OpenGL y-Axis starts at Bottom). For full width boxes
+            # of a bottom-up framebuffer (see rt3.SharedFramebuffer) this yields
+            # a contiguous part of the buffer itself, which is uploaded without a copy
+            region = np.flip(image[y0:y1, x0:x1], 0)
+            if not region.flags.c_contiguous:
+                region = np.ascontiguousarray(region)
+
+            # Re-Write the texture within the box only
+            viewport = (x0, height - y1, x1 - x0, y1 - y0)
+            if self.pbo is not None:
+                self.pbo.write(region)
+                self.gl_texture.write(self.pbo, viewport=viewport)
+            else:
+                self.gl_texture.write(region, viewport=viewport)
+
 
-        # Flip y-axis (OpenGL y-Axis starts at Bottom)
-        image = np.flip(image, 0)
+    def frame_ready(self):
+        return self.background.ready()
 
-        # Re-Write and Re-Bind texture
-        self.gl_texture.write(np.ascontiguousarray(image))
+
+    def close(self):
+        """
+        Stops the render thread, lets ray tracers with a close() method free
+        their resources (e.g. rt3's tile pool) and releases the GL objects.
+        """
+        self.background.close()
+        close = getattr(self.ray_tracer, "close", None)
+        if close is not None:
+            close()
+        if self.pbo is not None:
+            self.pbo.release()
+            self.pbo = None
+        if self.gl_texture is not None:
+            self.gl_texture.release()
+            self.gl_texture = None
 
 
     def render(self):
 
+        # Upload the latest finished ray traced frame, if any
+        self.background.upload(self.upload_ray_tracer_image)
+
         # Fill Background
         self.ctx.clear(*self.bg_color)
 
@@ -235,8 +431,14 @@ class RenderWindow:
 
         # set window callbacks
         glfw.set_mouse_button_callback(self.window, self.onMouseButton)
+        glfw.set_cursor_pos_callback(self.window, self.onMouseMove)
         glfw.set_key_callback(self.window, self.onKeyboard)
         glfw.set_window_size_callback(self.window, self.onSize)
+        glfw.set_window_refresh_callback(self.window, lambda win: self.invalidate())
+
+        # imgui handles text and scroll input itself, it needs redraws too
+        for set_callback in (glfw.set_char_callback, glfw.set_scroll_callback):
+            self.chain(set_callback)
 
         # create modernGL context and initialize GL objects in scene
         self.ctx = mgl.create_context()
@@ -247,26 +449,93 @@ class RenderWindow:
         # exit flag
         self.exitNow = False
 
+        # cursor position while dragging the camera, else None
+        self.drag = None
+
+        # window size not passed to the scene yet, the time it was set and
+        # when the first size change since the last resize came in
+        self.pending_size   = None
+        self.size_time      = 0.0
+        self.resize_time    = 0.0
+
+        # seconds the size has to settle before the scene is resized, and
+        # after which it is resized while the window is still being dragged
+        self.resize_delay       = 0.25
+        self.resize_deadline    = 1.0
+
+        # frames still to redraw, see invalidate(), and how long an idle
+        # window sleeps at most before looking for work again
+        self.redraw         = 1
+        self.idle_timeout   = 0.5
+
+        # new ray traced frames and tiles wake the main loop up
+        self.scene.background.notify = glfw.post_empty_event
+
+
+    def chain(self, set_callback):
+        # Installs a callback that marks the window dirty before calling the
+        # one set before (imgui's)
+        previous = set_callback(self.window, None)
+        def callback(*args):
+            self.invalidate()
+            if previous is not None:
+                previous(*args)
+        set_callback(self.window, callback)
+
+
+    def invalidate(self, frames=3):
+        # Redraws the next frames, imgui takes a few to show the effect of input
+        self.redraw = max(self.redraw, frames)
+
 
     def onMouseButton(self, win, button, action, mods):
+        self.invalidate()
         # Don't react to clicks on UI controllers
         if not imgui.get_io().want_capture_mouse:
             #print("mouse button: ", win, button, action, mods)
-            pass
+            if button == glfw.MOUSE_BUTTON_LEFT and action == glfw.PRESS:
+                self.drag = glfw.get_cursor_pos(win)
+        if button == glfw.MOUSE_BUTTON_LEFT and action == glfw.RELEASE:
+            self.drag = None
+
+
+    def onMouseMove(self, win, x, y):
+        # Dragging orbits the camera of ray tracers that have one, a drag
+        # across the window turns it half around
+        self.invalidate()
+        if self.drag is None or not hasattr(self.scene.ray_tracer, "orbit"):
+            return
+        (dx, dy) = (x - self.drag[0], y - self.drag[1])
+        self.drag = (x, y)
+        self.orbit(-np.pi * dx / self.width, np.pi * dy / self.height)
+
+
+    def orbit(self, yaw, pitch=0):
+        self.scene.update_ray_tracer_image(lambda: self.scene.ray_tracer.orbit(yaw, pitch))
 
 
     def onKeyboard(self, win, key, scancode, action, mods):
         #print("keyboard: ", win, key, scancode, action, mods)
+        self.invalidate()
         if action == glfw.PRESS:
             # ESC to quit
             if key == glfw.KEY_ESCAPE:
                 self.exitNow = True
             if key == glfw.KEY_N:
-                self.scene.ray_tracer.rotate_neg()
-                self.scene.update_ray_tracer_image()
+                self.scene.update_ray_tracer_image(self.scene.ray_tracer.rotate_neg)
             if key == glfw.KEY_P:
-                self.scene.ray_tracer.rotate_pos()
-                self.scene.update_ray_tracer_image()
+                self.scene.update_ray_tracer_image(self.scene.ray_tracer.rotate_pos)
+        if action in (glfw.PRESS, glfw.REPEAT) and hasattr(self.scene.ray_tracer, "orbit"):
+            # arrow keys orbit the camera in 5 degree steps
+            step = np.pi / 36
+            if key == glfw.KEY_LEFT:
+                self.orbit(step)
+            if key == glfw.KEY_RIGHT:
+                self.orbit(-step)
+            if key == glfw.KEY_UP:
+                self.orbit(0, step)
+            if key == glfw.KEY_DOWN:
+                self.orbit(0, -step)
 
 
     def onSize(self, win, width, height):
@@ -274,45 +543,111 @@ class RenderWindow:
         self.width          = width
         self.height         = height
         self.ctx.viewport   = (0, 0, self.width, self.height)
-        self.scene.resize(width, height)
-
 
-    def run(self):
-        # initializer timer
-        glfw.set_time(0.0)
-        t = 0.0
-        while not glfw.window_should_close(self.window) and not self.exitNow:
-            # update every x seconds
-            currT = glfw.get_time()
-            if currT - t > 1.0 / self.frame_rate:
-                # update time
-                t = currT
+        # Resizing the scene renders a new frame, wait until the size settled.
+        # Meanwhile the last frame is stretched over the new viewport
+        if self.pending_size is None:
+            self.resize_time = glfw.get_time()
+        self.pending_size   = (width, height)
+        self.size_time      = glfw.get_time()
 
-                # == Frame-wise IMGUI Setup ===
-                imgui.new_frame()                   # Start new frame context
-                imgui.begin("Controller")     # Start new window context
 
-                if imgui.button("Rotate + (p)"):
-                    self.scene.ray_tracer.rotate_pos()
-                    self.scene.update_ray_tracer_image()
+    def apply_resize(self):
+        # Passes a settled (or long pending) window size on to the scene
+        if self.pending_size is None:
+            return
+        now = glfw.get_time()
+        if now - self.size_time > self.resize_delay or now - self.resize_time > self.resize_deadline:
+            # minimized windows (size 0) keep their frame
+            if self.pending_size != (self.scene.width, self.scene.height) and min(self.pending_size) > 0:
+                self.scene.resize(*self.pending_size)
+            self.pending_size = None
+            self.invalidate()
+
+
+    def wait_time(self):
+        # seconds until the next thing to do: drawing a due frame, but not
+        # above frame_rate, or a pending resize, else idle_timeout
+        now = glfw.get_time()
+        if self.redraw > 0 or self.scene.frame_ready():
+            return self.last_frame + 1.0 / self.frame_rate - now
+        if self.pending_size is not None:
+            return min(self.size_time + self.resize_delay, self.resize_time + self.resize_deadline) - now
+        return self.idle_timeout
+
+
+    def profile_ui(self):
+        # cumulative count and time per stage, with its share of the total
+        stages = self.scene.ray_tracer.profile()
+        total = sum(seconds for (count, seconds) in stages.values()) or 1
+        imgui.separator()
+        imgui.text("%-10s %10s %9s %5s" % ("stage", "count", "ms", "%"))
+        for (stage, (count, seconds)) in stages.items():
+            imgui.text("%-10s %10d %9.1f %5.1f" % (stage, count, 1000 * seconds, 100 * seconds / total))
+        if imgui.button("Reset profile"):
+            self.scene.ray_tracer.reset_profile()
 
-                if imgui.button("Rotate - (n)"):
-                    self.scene.ray_tracer.rotate_neg()
-                    self.scene.update_ray_tracer_image()
 
-                imgui.end()                         # End window context
-                imgui.render()                      # Run render callback
-                imgui.end_frame()                   # End frame context
-                self.impl.process_inputs()          # Poll for UI events
+    def run(self):
+        # Event-driven main loop: sleeps in wait_events_timeout until input,
+        # a ray traced frame or a resize needs a redraw, so an idle window
+        # takes no CPU time from the ray tracing workers
+        glfw.set_time(0.0)
+        self.last_frame = -1.0
+        while not glfw.window_should_close(self.window) and not self.exitNow:
+            wait = self.wait_time()
+            if wait > 0:
+                glfw.wait_events_timeout(wait)  # Wait for GLFW events
+            else:
+                glfw.poll_events()              # Poll for GLFW events
+            self.apply_resize()                 # resize the scene once the window size settled
 
-                # == Rendering GL ===
-                glfw.poll_events()                  # Poll for GLFW events
-                self.ctx.clear()                    # clear viewport
-                self.scene.render()                 # render scene
-                self.impl.render(imgui.get_draw_data()) # render UI
-                glfw.swap_buffers(self.window)      # swap front and back buffer
+            currT = glfw.get_time()
+            if currT - self.last_frame < 1.0 / self.frame_rate:
+                continue
+            if self.redraw == 0 and not self.scene.frame_ready():
+                continue
+            self.last_frame = currT
+            self.redraw     = max(0, self.redraw - 1)
+
+            # == Frame-wise IMGUI Setup ===
+            imgui.new_frame()                   # Start new frame context
+            imgui.begin("Controller")     # Start new window context
+
+            if imgui.button("Rotate + (p)"):
+                self.scene.update_ray_tracer_image(self.scene.ray_tracer.rotate_pos)
+
+            if imgui.button("Rotate - (n)"):
+                self.scene.update_ray_tracer_image(self.scene.ray_tracer.rotate_neg)
+
+            # Light position of ray tracers that can move it
+            if hasattr(self.scene.ray_tracer, "move_light"):
+                changed, light = imgui.slider_float3("Light", *self.scene.ray_tracer.light(), -20, 20)
+                if changed:
+                    self.scene.update_ray_tracer_image(lambda: self.scene.ray_tracer.move_light(*light))
+
+            # Render scale and reflection depth of ray tracers with a frame budget
+            if getattr(self.scene.ray_tracer, "frame_budget", None):
+                imgui.text("Resolution %d%%, reflections %d" % (100 * self.scene.ray_tracer.scale,
+                                                               self.scene.ray_tracer.bounce))
+
+            # Per-stage timers of ray tracers that keep them
+            if getattr(self.scene.ray_tracer, "profile", None):
+                self.profile_ui()
+
+            imgui.end()                         # End window context
+            imgui.render()                      # Run render callback
+            imgui.end_frame()                   # End frame context
+            self.impl.process_inputs()          # Poll for UI events
+
+            # == Rendering GL ===
+            self.ctx.clear()                    # clear viewport
+            self.scene.render()                 # render scene
+            self.impl.render(imgui.get_draw_data()) # render UI
+            glfw.swap_buffers(self.window)      # swap front and back buffer
 
 
         # end
+        self.scene.close()
         self.impl.shutdown()
         glfw.terminate()
@@ -1,51 +1,88 @@
-from PIL import Image
-from functools import reduce
 import numpy as np
 import time
-import numbers
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import atexit
+from collections import OrderedDict
 
 
-def extract(cond, x):
-    if isinstance(x, numbers.Number):
-        return x
-    else:
-        return np.extract(cond, x)
-
 class vec3():
-    def __init__(self, x, y, z):
-        (self.x, self.y, self.z) = (x, y, z)
-    def __mul__(self, other):
-        return vec3(self.x * other, self.y * other, self.z * other)
-    def __add__(self, other):
-        return vec3(self.x + other.x, self.y + other.y, self.z + other.z)
-    def __sub__(self, other):
-        return vec3(self.x - other.x, self.y - other.y, self.z - other.z)
+    # 3D vector (or batch of vectors) backed by one contiguous (3, ...) array,
+    # a holds the x, y and z components along the first axis. Constants use
+    # shape (3, 1) so they broadcast against batches of shape (3, n).
+    dtype = np.float64              # see set_precision(), float32 halves the memory traffic
+
+    def __init__(self, x, y = None, z = None, dtype = None):
+        if y is None:
+            self.a = np.asarray(x)
+        else:
+            self.a = np.array(np.broadcast_arrays(*np.atleast_1d(x, y, z)), dtype=dtype or vec3.dtype)
+
+    @property
+    def x(self):
+        return self.a[0]
+    @x.setter
+    def x(self, value):
+        self.a[0] = value
+    @property
+    def y(self):
+        return self.a[1]
+    @y.setter
+    def y(self, value):
+        self.a[1] = value
+    @property
+    def z(self):
+        return self.a[2]
+    @z.setter
+    def z(self, value):
+        self.a[2] = value
+
+    def __mul__(self, other, out = None):
+        return vec3(np.multiply(self.a, other, out=out))
+    def __add__(self, other, out = None):
+        return vec3(np.add(self.a, other.a, out=out))
+    def __sub__(self, other, out = None):
+        return vec3(np.subtract(self.a, other.a, out=out))
+    def inplace(self, ufunc, other):
+        # Updates a in place when the result has its shape, else rebinds it
+        if np.broadcast_shapes(self.a.shape, np.shape(other)) == self.a.shape and self.a.flags.writeable:
+            ufunc(self.a, other, out=self.a)
+        else:
+            self.a = ufunc(self.a, other)
+        return self
+    def __imul__(self, other):
+        return self.inplace(np.multiply, other)
+    def __iadd__(self, other):
+        return self.inplace(np.add, other.a)
+    def __isub__(self, other):
+        return self.inplace(np.subtract, other.a)
     def dot(self, other):
-        return (self.x * other.x) + (self.y * other.y) + (self.z * other.z)
+        (a, b) = (self.a, other.a)
+        return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
     def __abs__(self):
         return self.dot(self)
-    def norm(self):
+    def norm(self, out = None):
         mag = np.sqrt(abs(self))
-        return self * (1.0 / np.where(mag == 0, 1, mag))
+        return self.__mul__(1.0 / np.where(mag == 0, 1, mag), out)
     def components(self):
-        return (self.x, self.y, self.z)
-    def extract(self, cond):
-        return vec3(extract(cond, self.x),
-                    extract(cond, self.y),
-                    extract(cond, self.z))
-    def place(self, cond):
-        r = vec3(np.zeros(cond.shape), np.zeros(cond.shape), np.zeros(cond.shape))
-        np.place(r.x, cond, self.x)
-        np.place(r.y, cond, self.y)
-        np.place(r.z, cond, self.z)
-        return r
-
-    def cross(self, other):
-        x = self.y * other.z - self.z * other.y
-        y = self.z * other.x - self.x * other.z
-        z = self.x * other.y - self.y * other.x
-        return vec3(x, y, z)
+        return (self.a[0], self.a[1], self.a[2])
+    def array(self):
+        # the single vector of a constant as (3,) array
+        return self.a.reshape(3)
+    def batched(self):
+        return self.a.ndim > 1 and self.a.shape[1:] != (1,)
+    def take(self, idx):
+        # gathers the rays idx of a batch, constants are shared by all rays
+        return vec3(self.a[:, idx]) if self.batched() else self
+
+    def cross(self, other, out = None):
+        (a, b) = np.broadcast_arrays(self.a, other.a)
+        if out is None:
+            out = np.empty(a.shape, dtype=np.result_type(a, b))
+        np.multiply(a[1], b[2], out=out[0]); out[0] -= a[2] * b[1]
+        np.multiply(a[2], b[0], out=out[1]); out[1] -= a[0] * b[2]
+        np.multiply(a[0], b[1], out=out[2]); out[2] -= a[1] * b[0]
+        return vec3(out)
 
     def rotate(self, axis, angle):
         return self * np.cos(angle) + axis.cross(self) * np.sin(angle) + axis * axis.dot(self) * (1 - np.cos(angle))
@@ -54,26 +91,365 @@ rgb = vec3
 
 (w, h) = (640, 480)         # Screen size
 L = vec3(5, 5, -10)        # Point light position
-E = vec3(0, 0.35, -1)     # Eye position
-FARAWAY = 1.0e39            # an implausibly huge distance
+E = vec3(0, 0.35, -1)     # Eye position of the default camera
+FARAWAY = 1.0e30            # an implausibly huge distance, still finite in float32
+MAX_BOUNCE = 2              # reflections are traced up to this bounce
+MIN_WEIGHT = 1 / 255        # rays contributing less than one 8-bit step are dropped
+AA_THRESHOLD = 64           # luminance step between neighbours that counts as an edge
+NUDGE = .0001               # offset of secondary ray origins from the surface
+NUDGE_ULPS = 16             # ... and at least this many rounding steps of the hit point
+MEMORY_BUDGET = 256 << 20   # bytes the rays traced at once may take
+RAY_BYTES = 512             # peak memory per ray in flight (about 435 measured)
+RAY_CACHE_BYTES = 64 << 20  # primary ray directions kept per process, at most
+                            # a quarter of the memory budget of main_scene
+
+# Random stream of russian roulette, one per process (see init_tile_worker)
+# so tiles, bands and frames each draw fresh numbers
+rng = np.random.default_rng()
+
+# Stages of the tracer and what each one counts
+STAGES = {
+    "primary":    "primary_rays",       # intersecting camera rays
+    "shadow":     "shadow_rays",        # occlusion tests towards the light
+    "shading":    "shaded_points",      # surface lookups and local shading
+    "reflection": "reflection_rays",    # reflecting and intersecting rays
+    "image":      "image_pixels",       # colour to 8-bit framebuffer pixels
+    "antialias":  "edge_pixels",        # finding the pixels to antialias
+}
+
+# Counters and cumulative seconds of the stages in this process (tile
+# workers report theirs back to the pool, so their seconds add up CPU time)
+stats = dict.fromkeys(list(STAGES.values()) + [stage + "_seconds" for stage in STAGES], 0)
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0
+
+def add_stats(delta):
+    for (key, value) in delta.items():
+        stats[key] += value
+
+def timed(stage, t0, count = 0):
+    # Adds the time since t0 and count to stage, returns the current time
+    t = time.perf_counter()
+    stats[stage + "_seconds"] += t - t0
+    stats[STAGES[stage]] += count
+    return t
+
+def profile():
+    # Cumulative (count, seconds) per stage since the last reset_stats()
+    return {stage: (stats[counter], stats[stage + "_seconds"]) for (stage, counter) in STAGES.items()}
+
+class BVH:
+    # Bounding volume hierarchy over axis aligned boxes. lo and hi are (N, 3)
+    # arrays with the bounds of N primitives, leaves hold up to leaf_size of them.
+    def __init__(self, lo, hi, leaf_size = 4):
+        lo = np.asarray(lo, dtype=vec3.dtype).reshape(-1, 3)
+        hi = np.asarray(hi, dtype=vec3.dtype).reshape(-1, 3)
+        pad = max(1e-6, 16 * np.finfo(vec3.dtype).eps) * np.maximum(1, np.abs(hi - lo).max(initial=0))
+        (self.prim_lo, self.prim_hi) = (lo - pad, hi + pad)
+        self.centroid = (lo + hi) / 2
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(lo))
+        self.nodes = []
+        if len(lo):
+            self.build(0, len(lo))
+        # node layout: lo (3), hi (3), left, right, start, count, axis
+        self.lo = np.array([n[0] for n in self.nodes]).reshape(-1, 3)
+        self.hi = np.array([n[1] for n in self.nodes]).reshape(-1, 3)
+        (self.left, self.right, self.start, self.count, self.axis) = (
+            np.array([n[k] for n in self.nodes], dtype=int) for k in range(2, 7))
+        del self.nodes
+
+    def build(self, start, end):
+        idx = self.order[start:end]
+        node = len(self.nodes)
+        entry = [self.prim_lo[idx].min(axis=0), self.prim_hi[idx].max(axis=0), -1, -1, start, end - start, 0]
+        self.nodes.append(entry)
+        if end - start <= self.leaf_size:
+            return node
+        # split at the median centroid along the longest axis
+        c = self.centroid[idx]
+        axis = int(np.argmax(c.max(axis=0) - c.min(axis=0)))
+        mid = (end - start) // 2
+        self.order[start:end] = idx[np.argpartition(c[:, axis], mid)]
+        entry[2] = self.build(start, start + mid)
+        entry[3] = self.build(start + mid, end)
+        entry[6] = axis
+        return node
+
+    def setup(self, O, D):
+        # Ray count, origins and inverse directions as (3, n) arrays and the
+        # mean direction, which orders the children visited
+        n = np.broadcast(D.a[0], O.a[0]).size
+        o = np.broadcast_to(O.a.reshape(3, -1), (3, n))
+        with np.errstate(divide='ignore'):
+            inv = 1.0 / np.broadcast_to(D.a.reshape(3, -1), (3, n))
+        return n, o, inv, D.a.reshape(3, -1).mean(axis=1)
+
+    def enter(self, node, o, inv, idx, limit):
+        # Slab test: the rays idx that enter the box of node before limit
+        oi, ii = o[:, idx], inv[:, idx]
+        t0 = (self.lo[node, :, np.newaxis] - oi) * ii
+        t1 = (self.hi[node, :, np.newaxis] - oi) * ii
+        (tmin, tmax) = (np.fmin(t0, t1), np.fmax(t0, t1))
+        tnear = np.fmax(np.fmax(np.fmax(tmin[0], tmin[1]), tmin[2]), 0)
+        tfar = np.fmin(np.fmin(np.fmin(tmax[0], tmax[1]), tmax[2]), limit)
+        return idx[tnear <= tfar]
+
+    def children(self, node, mean_d):
+        # the child nearer to the rays comes last, so it is popped first
+        if mean_d[self.axis[node]] > 0:
+            return (self.right[node], self.left[node])
+        return (self.left[node], self.right[node])
+
+    def traverse(self, O, D, leaf, faces = False):
+        # Intersects a whole batch of rays with the hierarchy. leaf(prims, O, D)
+        # returns the (len(prims), n) hit distances of the given primitives for
+        # the n rays in O, D. Returns nearest distance and primitive id per ray,
+        # FARAWAY and -1 for rays that hit nothing. With faces leaf returns the
+        # distances and the (len(prims), n) faces hit within the primitives,
+        # the face of the nearest hit (-1 for none) is returned as well.
+        n, o, inv, mean_d = self.setup(O, D)
+        nearest = np.full(n, FARAWAY, dtype=vec3.dtype)
+        ids = np.full(n, -1)
+        face = np.full(n, -1)
+        if not len(self.order):
+            return (nearest, ids, face) if faces else (nearest, ids)
 
-def raytrace(O, D, scene, bounce = 0):
+        stack = [(0, np.arange(n))]
+        with np.errstate(invalid='ignore'):
+            while stack:
+                node, idx = stack.pop()
+                idx = self.enter(node, o, inv, idx, nearest[idx])
+                if not len(idx):
+                    continue
+                if self.left[node] < 0:
+                    prims = self.order[self.start[node]:self.start[node] + self.count[node]]
+                    d = leaf(prims, O.take(idx), D.take(idx))
+                    if faces:
+                        (d, f) = d
+                    d = np.asarray(d).reshape(len(prims), len(idx))
+                    k = np.argmin(d, axis=0)
+                    dk = d[k, np.arange(len(idx))]
+                    closer = dk < nearest[idx]
+                    nearest[idx[closer]] = dk[closer]
+                    ids[idx[closer]] = prims[k[closer]]
+                    if faces:
+                        face[idx[closer]] = np.asarray(f).reshape(len(prims), len(idx))[k[closer], np.flatnonzero(closer)]
+                else:
+                    stack.extend((child, idx) for child in self.children(node, mean_d))
+        return (nearest, ids, face) if faces else (nearest, ids)
+
+    def occluded(self, O, D, tmax, leaf):
+        # Any-hit query: True for the rays that hit some primitive closer than
+        # tmax. leaf(prims, O, D, tmax) returns that per ray for a leaf. A ray
+        # leaves the traversal as soon as one occluder is found.
+        n, o, inv, mean_d = self.setup(O, D)
+        tmax = np.broadcast_to(tmax, n)
+        blocked = np.zeros(n, dtype=bool)
+        if not len(self.order):
+            return blocked
+
+        stack = [(0, np.arange(n))]
+        with np.errstate(invalid='ignore'):
+            while stack:
+                node, idx = stack.pop()
+                idx = idx[~blocked[idx]]
+                if len(idx):
+                    idx = self.enter(node, o, inv, idx, tmax[idx])
+                if not len(idx):
+                    continue
+                if self.left[node] < 0:
+                    prims = self.order[self.start[node]:self.start[node] + self.count[node]]
+                    blocked[idx] = leaf(prims, O.take(idx), D.take(idx), tmax[idx])
+                else:
+                    stack.extend((child, idx) for child in self.children(node, mean_d))
+        return blocked
+
+class SceneBVH:
+    # Acceleration structure over a list of scene objects. Objects without
+    # bounds (planes) are kept as unbounded extras and tested against every ray.
+    def __init__(self, objects):
+        self.objects = list(objects)
+        bounds = [s.bounds() for s in self.objects]
+        self.bounded = np.array([i for (i, b) in enumerate(bounds) if b is not None], dtype=int)
+        self.unbounded = [i for (i, b) in enumerate(bounds) if b is None]
+        self.bvh = BVH([bounds[i][0] for i in self.bounded], [bounds[i][1] for i in self.bounded])
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def index(self, obj):
+        return self.objects.index(obj)
+
+    def intersect(self, O, D):
+        # Returns nearest distance, object id (index into objects) and face per
+        # ray. The face is what intersect_faces of meshes found, -1 for other
+        # objects, so their normal need not be searched for again
+        leaf = lambda prims, Op, Dp: tuple(zip(*(self.faces(self.objects[self.bounded[p]], Op, Dp) for p in prims)))
+        nearest, ids, face = self.bvh.traverse(O, D, leaf, faces=True)
+        ids = np.where(ids >= 0, self.bounded[np.maximum(ids, 0)], -1) if len(self.bounded) else ids
+        for i in self.unbounded:
+            (d, f) = self.faces(self.objects[i], O, D)
+            closer = d < nearest
+            nearest = np.where(closer, d, nearest)
+            ids = np.where(closer, i, ids)
+            face = np.where(closer, f, face)
+        return nearest, ids, face
+
+    @staticmethod
+    def faces(s, O, D):
+        # distances and faces hit on object s
+        if hasattr(s, "intersect_faces"):
+            return s.intersect_faces(O, D)
+        d = s.intersect(O, D)
+        return (d, np.full(np.shape(d), -1))
+
+    def occluded(self, O, D, tmax):
+        # True for the rays that hit any object before distance tmax
+        blocked = np.zeros(np.broadcast(O.a[0], D.a[0]).size, dtype=bool)
+        for i in self.unbounded:
+            blocked |= self.objects[i].occluded(O, D, tmax)
+        rest = np.flatnonzero(~blocked)
+        if len(rest) and len(self.bounded):
+            blocked[rest] = self.bvh.occluded(O.take(rest), D.take(rest), tmax[rest], self.leaf_occluded)
+        return blocked
+
+    def leaf_occluded(self, prims, O, D, tmax):
+        blocked = np.zeros(len(tmax), dtype=bool)
+        for p in prims:
+            blocked |= self.objects[self.bounded[p]].occluded(O, D, tmax)
+        return blocked
+
+def surfaces(O, D, M, ids, scene, N = None, faces = None):
+    # Normal, diffuse colour and mirror factor at the hit points M of the rays
+    # O, D on the objects ids, asked from every object hit for its own rays.
+    # Known normals N are passed through, only the materials are looked up.
+    # faces are the faces hit on meshes (see SceneBVH.intersect), they take
+    # the normals from them
+    n = len(ids)
+    known = N is not None
+    N = N.a if known else np.empty((3, n), dtype=vec3.dtype)
+    diffuse = np.empty((3, n), dtype=vec3.dtype)
+    mirror = np.empty(n, dtype=vec3.dtype)
+    order = np.argsort(ids, kind='stable')
+    (objects, starts) = np.unique(ids[order], return_index=True)
+    for (i, idx) in zip(objects, np.split(order, starts[1:])):
+        s = scene.objects[i]
+        Mi = M.take(idx)
+        if not known and faces is not None and hasattr(s, "intersect_faces"):
+            N[:, idx] = s.normal(O.take(idx), D.take(idx), Mi, faces[idx]).a
+        elif not known:
+            N[:, idx] = s.normal(O.take(idx), D.take(idx), Mi).a
+        diffuse[:, idx] = s.diffusecolor(Mi).a
+        mirror[idx] = s.mirror
+    return vec3(N), vec3(diffuse), mirror
+
+def raytrace(O, D, scene, bounce = 0, max_bounce = None, min_weight = None, roulette = False, gbuffer = None,
+             ids_only = False):
     # O is the ray origin, D is the normalized ray direction
-    # scene is a list of Sphere objects (see below)
+    # scene is a SceneBVH over the objects (see below)
     # bounce is the number of the bounce, starting at zero for camera rays
+    # max_bounce and min_weight default to MAX_BOUNCE and MIN_WEIGHT: rays
+    # stop after max_bounce reflections or once the product of the mirror
+    # factors along them (their weight) drops below min_weight. With roulette
+    # such rays survive with probability weight / min_weight instead, at
+    # weight min_weight, which keeps the expected colour unbiased
+    # gbuffer, a dict, receives the first hit of every ray: object "ids" (-1
+    # for none), "distance", "position" and "normal". If it holds them
+    # already the rays are shaded from it instead of being traced again.
+    # With ids_only it only receives "ids" and "distance", which cost nothing
+    # The highlights are computed for a viewer at O, the camera of the rays
+
+    # Wavefront tracing: each bounce intersects, shades and shadow tests all
+    # live rays as one batch, whatever they hit, then continues with their
+    # reflections. Rays are index lists into the pixels, missed rays drop out
+    max_bounce = MAX_BOUNCE if max_bounce is None else max_bounce
+    min_weight = MIN_WEIGHT if min_weight is None else min_weight
+    eye = O
+    n = np.broadcast(O.a[0], D.a[0]).size
+    color = np.zeros((3, n), dtype=vec3.dtype)
+    rays = np.arange(n)                         # pixel of every live ray
+    weight = np.ones(n, dtype=vec3.dtype)       # product of mirror factors so far
+    first = True
+    reuse = gbuffer is not None and "ids" in gbuffer
+    if not reuse:
+        stats["primary_rays" if bounce == 0 else "reflection_rays"] += n
+    t = time.perf_counter()
+    while True:
+        if first and reuse:
+            (nearest, ids) = (gbuffer["distance"], gbuffer["ids"])
+        else:
+            nearest, ids, faces = scene.intersect(O, D)
+            t = timed("primary" if first and bounce == 0 else "reflection", t)
+        hit = np.flatnonzero(ids >= 0)
+        if first and gbuffer is not None and not reuse:
+            gbuffer.update(ids=ids, distance=nearest)
+            if not ids_only:
+                gbuffer.update(position=np.zeros((3, n), dtype=vec3.dtype), normal=np.zeros((3, n), dtype=vec3.dtype))
+        if not len(hit):
+            break
+        (rays, weight, ids) = (rays[hit], weight[hit], ids[hit])
+        (O, D) = (O.take(hit), D.take(hit))
 
-    distances = [s.intersect(O, D) for s in scene]
-    nearest = reduce(np.minimum, distances)
-    color = rgb(0, 0, 0)
-    for (s, d) in zip(scene, distances):
-        hit = (nearest != FARAWAY) & (d == nearest)
-        if np.any(hit):
-            dc = extract(hit, d)
-            Oc = O.extract(hit)
-            Dc = D.extract(hit)
-            cc = s.light(Oc, Dc, dc, scene, bounce)
-            color += cc.place(hit)
-    return color
+        if first and reuse:
+            M = vec3(gbuffer["position"][:, hit])
+            (N, diffuse, mirror) = surfaces(O, D, M, ids, scene, vec3(gbuffer["normal"][:, hit]))
+        else:
+            M = (O + D * nearest[hit])          # intersection point
+            (N, diffuse, mirror) = surfaces(O, D, M, ids, scene, faces=faces[hit])
+            if first and gbuffer is not None and not ids_only:
+                (gbuffer["position"][:, hit], gbuffer["normal"][:, hit]) = (M.a, N.a)
+        first = False
+        toL = cast(L) - M
+        light_distance = np.sqrt(abs(toL))
+        toL = toL * (1. / light_distance)       # direction to light
+        toO = (eye - M).norm()                  # direction to the camera
+        # M nudged to avoid itself, further than its rounding error in float32
+        nudged = M + N * np.maximum(NUDGE, NUDGE_ULPS * np.finfo(vec3.dtype).eps * np.abs(M.a).max(axis=0))
+        t = timed("shading", t, len(hit))
+
+        # Shadow: find if the point is shadowed or not.
+        # This amounts to finding out if anything between M and the light
+        seelight = ~scene.occluded(nudged, toL, light_distance)
+        t = timed("shadow", t, len(hit))
+
+        # Ambient
+        local = rgb(0.05, 0.05, 0.05)
+
+        # Lambert shading (diffuse)
+        lv = np.maximum(N.dot(toL), 0)
+        local += diffuse * lv * seelight
+
+        # Blinn-Phong shading (specular)
+        phong = N.dot((toL + toO).norm())
+        local += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
+        color[:, rays] += local.a * weight
+        t = timed("shading", t)
+
+        # Reflection, only for the rays that still contribute
+        if bounce >= max_bounce:
+            break
+        weight = weight * mirror
+        keep = weight >= min_weight
+        if roulette:
+            survive = ~keep & (rng.random(len(weight)) * min_weight < weight)
+            weight = np.where(survive, min_weight, weight)
+            keep |= survive
+        keep = np.flatnonzero(keep)
+        if not len(keep):
+            break
+        (rays, weight, N) = (rays[keep], weight[keep], N.take(keep))
+        D = D.take(keep)
+        D = (D - N * 2 * D.dot(N)).norm()
+        O = nudged.take(keep)
+        bounce += 1
+        t = timed("reflection", t, len(keep))
+    return vec3(color)
 
 class Sphere:
     def __init__(self, center, r, diffuse, mirror = 0.5):
@@ -93,41 +469,18 @@ class Sphere:
         pred = (disc > 0) & (h > 0)
         return np.where(pred, h, FARAWAY)
 
-    def diffusecolor(self, M):
-        return self.diffuse
-
-
-
+    def occluded(self, O, D, tmax):
+        return self.intersect(O, D) < tmax
 
-    def light(self, O, D, d, scene, bounce):
-        M = (O + D * d)                         # intersection point
-        N = (M - self.c) * (1. / self.r)        # normal
-        toL = (L - M).norm()                    # direction to light
-        toO = (E - M).norm()                    # direction to ray origin
-        nudged = M + N * .0001                  # M nudged to avoid itself
-
-        # Shadow: find if the point is shadowed or not.
-        # This amounts to finding out if M can see the light
-        light_distances = [s.intersect(nudged, toL) for s in scene]
-        light_nearest = reduce(np.minimum, light_distances)
-        seelight = light_distances[scene.index(self)] == light_nearest
-
-        # Ambient
-        color = rgb(0.05, 0.05, 0.05)
-
-        # Lambert shading (diffuse)
-        lv = np.maximum(N.dot(toL), 0)
-        color += self.diffusecolor(M) * lv * seelight
+    def bounds(self):
+        c = self.c.array()
+        return (c - self.r, c + self.r)
 
-        # Reflection
-        if bounce < 2:
-            rayD = (D - N * 2 * D.dot(N)).norm()
-            color += raytrace(nudged, rayD, scene, bounce + 1) * self.mirror
+    def diffusecolor(self, M):
+        return self.diffuse
 
-        # Blinn-Phong shading (specular)
-        phong = N.dot((toL + toO).norm())
-        color += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
-        return color
+    def normal(self, O, D, M):
+        return (M - self.c) * (1. / self.r)
 
 class CheckeredSphere(Sphere):
     def diffusecolor(self, M):
@@ -152,45 +505,104 @@ class Triangle:
         r = 1 / cross_v_u_dot * (D.cross(v).dot(w))
         s = 1 / cross_v_u_dot * (w.cross(u).dot(D))
 
-        pred = np.logical_and.reduce((r >= 0, r <= 1, s >= 0, s <= 1, r + s <= 1))
+        pred = np.logical_and.reduce((r >= 0, r <= 1, s >= 0, s <= 1, r + s <= 1, t > 0))
         return np.where(pred, t, FARAWAY)
 
+    def occluded(self, O, D, tmax):
+        return self.intersect(O, D) < tmax
+
+    def bounds(self):
+        p = np.array([self.a.array(), self.b.array(), self.c.array()])
+        return (p.min(axis=0), p.max(axis=0))
+
     def diffusecolor(self, M):
         return self.diffuse
 
     def intersect_normal(self, a, b, c):
         return (a - b).cross(c - b).norm()
 
+    def normal(self, O, D, M):
+        return self.intersect_normal(self.a, self.b, self.c)
+
+class TriangleMesh:
+    # Triangle mesh stored as structure-of-arrays: vertices (V, 3), faces (F, 3)
+    # and per face the corner v0 and edges e1, e2 as (3, F) component arrays.
+    # Rays are intersected against whole BVH leaves at once (Moller-Trumbore).
+    def __init__(self, vertices, faces, diffuse, mirror = 0.25):
+        self.vertices = np.ascontiguousarray(vertices, dtype=vec3.dtype)
+        self.faces = np.ascontiguousarray(faces, dtype=int)
+        self.diffuse = diffuse
+        self.mirror = mirror
 
-    def light(self, O, D, d, scene, bounce):
-        M = (O + D * d)  # intersection point
-        N = self.intersect_normal(self.a, self.b, self.c)  # normal
-        toL = (L - M).norm()  # direction to light
-        toO = (E - M).norm()  # direction to ray origin
-        nudged = M + N * .0001  # M nudged to avoid itself
+        p0, p1, p2 = (self.vertices[self.faces[:, k]] for k in range(3))
+        self.v0 = np.ascontiguousarray(p0.T)
+        self.e1 = np.ascontiguousarray((p1 - p0).T)
+        self.e2 = np.ascontiguousarray((p2 - p0).T)
+        n = np.cross(p1 - p0, p2 - p0)
+        length = np.linalg.norm(n, axis=1, keepdims=True)
+        self.normals = np.ascontiguousarray((n / np.where(length == 0, 1, length)).T)
+        corners = np.stack((p0, p1, p2))
+        self.bvh = BVH(corners.min(axis=0), corners.max(axis=0), leaf_size = 32)
 
-        # Shadow: find if the point is shadowed or not.
-        # This amounts to finding out if M can see the light
-        light_distances = [s.intersect(nudged, toL) for s in scene]
-        light_nearest = reduce(np.minimum, light_distances)
-        seelight = light_distances[scene.index(self)] == light_nearest
+    @classmethod
+    def from_obj(cls, path, diffuse, mirror = 0.25, center = vec3(0, 0, 0), size = 1.0):
+        # Loads the v and f records of an OBJ file (polygons are fanned into
+        # triangles) and fits the model into a box of edge length size at center.
+        vertices, faces = [], []
+        with open(path, "r") as file:
+            for line in file:
+                if line.startswith('v '):
+                    vertices.append([float(c) for c in line.split()[1:4]])
+                elif line.startswith('f '):
+                    idx = [int(v.split('/')[0]) for v in line.split()[1:]]
+                    idx = [i - 1 if i > 0 else len(vertices) + i for i in idx]
+                    faces.extend([idx[0], idx[k], idx[k + 1]] for k in range(1, len(idx) - 1))
+        vertices = np.array(vertices, dtype=float)
+        lo, hi = vertices.min(axis=0), vertices.max(axis=0)
+        scale = size / max((hi - lo).max(), 1e-12)
+        vertices = (vertices - (lo + hi) / 2) * scale + center.array()
+        return cls(vertices, np.array(faces, dtype=int).reshape(-1, 3), diffuse, mirror)
 
-        # Ambient
-        color = rgb(0.05, 0.05, 0.05)
+    def leaf(self, prims, O, D):
+        # Vectorized Moller-Trumbore: (len(prims), n) distances for n rays
+        (O, D) = (vec3(O.a.reshape(3, 1, -1)), vec3(D.a.reshape(3, 1, -1)))
+        v0 = vec3(self.v0[:, prims, np.newaxis])
+        e1 = vec3(self.e1[:, prims, np.newaxis])
+        e2 = vec3(self.e2[:, prims, np.newaxis])
+        p = D.cross(e2)
+        det = e1.dot(p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv = 1.0 / det
+            s = O - v0
+            u = s.dot(p) * inv
+            q = s.cross(e1)
+            v = D.dot(q) * inv
+            t = e2.dot(q) * inv
+            pred = (np.abs(det) > 1e-12) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 0)
+        return np.where(pred, t, FARAWAY)
 
-        # Lambert shading (diffuse)
-        lv = np.maximum(N.dot(toL), 0)
-        color += self.diffusecolor(M) * lv * seelight
+    def intersect_faces(self, O, D):
+        return self.bvh.traverse(O, D, self.leaf)
 
-        # Reflection
-        if bounce < 2:
-            rayD = (D - N * 2 * D.dot(N)).norm()
-            color += raytrace(nudged, rayD, scene, bounce + 1) * self.mirror
+    def intersect(self, O, D):
+        return self.intersect_faces(O, D)[0]
 
-        # Blinn-Phong shading (specular)
-        phong = N.dot((toL + toO).norm())
-        color += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
-        return color
+    def occluded(self, O, D, tmax):
+        leaf = lambda prims, Op, Dp, t: (self.leaf(prims, Op, Dp) < t).any(axis=0)
+        return self.bvh.occluded(O, D, tmax, leaf)
+
+    def bounds(self):
+        return (self.vertices.min(axis=0), self.vertices.max(axis=0))
+
+    def diffusecolor(self, M):
+        return self.diffuse
+
+    def normal(self, O, D, M, face = None):
+        # face is the one hit, if known (see SceneBVH.intersect)
+        if face is None:
+            face = self.intersect_faces(O, D)[1]
+        N = vec3(self.normals[:, face])  # face normal
+        return N * np.where(N.dot(D) > 0, -1, 1)  # facing the incoming ray
 
 class Plane:
     def __init__(self, center, normal, diffuse, mirror=0.05):
@@ -203,39 +615,18 @@ class Plane:
         s = -self.n.dot(O - self.c) / self.n.dot(D)
         return np.where((s > 0), s, FARAWAY)
 
+    def occluded(self, O, D, tmax):
+        return self.intersect(O, D) < tmax
+
+    def bounds(self):
+        return None
+
     def diffusecolor(self, M):
         checker = (np.ceil((M.x * 2)) % 2) == (np.ceil((M.z * 2)) % 2)
         return self.diffuse * checker
 
-    def light(self, O, D, d, scene, bounce):
-        M = (O + D * d)  # intersection point
-        N = self.n  # normal
-        toL = (L - M).norm()  # direction to light
-        toO = (E - M).norm()  # direction to ray origin
-        nudged = M + N * .0001  # M nudged to avoid itself
-
-        # Shadow: find if the point is shadowed or not.
-        # This amounts to finding out if M can see the light
-        light_distances = [s.intersect(nudged, toL) for s in scene]
-        light_nearest = reduce(np.minimum, light_distances)
-        seelight = light_distances[scene.index(self)] == light_nearest
-
-        # Ambient
-        color = rgb(0.05, 0.05, 0.05)
-
-        # Lambert shading (diffuse)
-        lv = np.maximum(N.dot(toL), 0)
-        color += self.diffusecolor(M) * lv * seelight
-
-        # Reflection
-        if bounce < 2:
-            rayD = (D - N * 2 * D.dot(N)).norm()
-            color += raytrace(nudged, rayD, scene, bounce + 1) * self.mirror
-
-        # Blinn-Phong shading (specular)
-        phong = N.dot((toL + toO).norm())
-        color += rgb(1, 1, 1) * np.power(np.clip(phong, 0, 1), 50) * seelight
-        return color
+    def normal(self, O, D, M):
+        return self.n
 
 
 
@@ -250,35 +641,500 @@ scene = [
         Triangle(vec3(-.5, .1, 2), vec3(.75, .1, 2), vec3(0, 1.25, 2.25), vec3(1, 1, 0), .25),
 
 ]
-def main_scene(self, w, h, p=False, n=False):
-    self.w = w
-    self.h = h
-    self.p = p
-    self.n = n
+accel = SceneBVH(scene)
+
+def load_scene(objects):
+    # Replaces the objects of the scene and rebuilds its hierarchy
+    global accel
+    scene[:] = objects
+    accel = SceneBVH(scene)
+
+def cast(value):
+    # value with its floating point arrays in vec3.dtype. Arrays and vec3 are
+    # returned as copies (or as is when they match), other objects such as
+    # primitives and their hierarchies are converted in place
+    if isinstance(value, vec3):
+        return vec3(cast(value.a))
+    if isinstance(value, (np.ndarray, np.floating)):
+        return value.astype(vec3.dtype, copy=False) if value.dtype.kind == 'f' else value
+    if hasattr(value, '__dict__'):
+        for (name, attr) in vars(value).items():
+            setattr(value, name, cast(attr))
+    return value
+
+def set_precision(dtype):
+    # Traces in float32 or float64 from now on. The objects of the scene are
+    # converted, L and cameras stay as they are and are converted where used
+    global accel
+    vec3.dtype = np.dtype(dtype).type
+    for obj in scene:
+        cast(obj)
+    accel = SceneBVH(scene)
+
+def add_model(path, diffuse = vec3(.9, .9, .9), center = vec3(0, -.1, 1.2), size = .8):
+    # Adds an OBJ model (e.g. from OpenGL_Mesh_Viewer/models) to the scene
+    load_scene(scene + [TriangleMesh.from_obj(path, diffuse, center=center, size=size)])
+
+class Camera:
+    # Pinhole camera at eye looking at target. up is the world direction that
+    # shows upwards, fov the horizontal field of view in degrees. Moving the
+    # camera only changes the primary rays, the scene and its BVH stay as is.
+    def __init__(self, eye, target, up = vec3(0, 1, 0), fov = 90):
+        self.eye = eye
+        self.target = target
+        self.up = up
+        self.fov = fov
+
+    def screen(self, w, h):
+        # Coordinates of the pixel columns and rows on the image plane at
+        # distance 1 in front of the eye, x to the right and y upwards
+        t = np.tan(np.radians(self.fov) / 2)
+        r = float(w) / h
+        return np.linspace(-t, t, w, dtype=vec3.dtype), np.linspace(t / r, -t / r, h, dtype=vec3.dtype)
+
+    def rays(self, x, y):
+        # Origin and directions of the rays through the image plane points x, y
+        forward = (self.target - self.eye).norm()
+        right = self.up.cross(forward).norm()
+        up = forward.cross(right)
+        (forward, right, up) = (cast(forward), cast(right), cast(up))
+        return cast(self.eye), (forward + right * x + up * y).norm()
+
+    def pose(self):
+        # hashable state of the camera, equal for equal rays
+        return tuple(self.eye.array().tolist() + self.target.array().tolist() + self.up.array().tolist()) + (self.fov,)
+
+    def orbit(self, yaw, pitch = 0):
+        # Moves the eye around the target, by yaw radians about up and pitch
+        # radians upwards, stopping short of looking straight along up
+        axis = self.up.norm()
+        offset = (self.eye - self.target).rotate(axis, yaw)
+        elevation = np.arccos(np.clip(offset.norm().dot(axis), -1, 1)).item()
+        pitch = elevation - np.clip(elevation - pitch, .05, np.pi - .05)
+        offset = offset.rotate(offset.cross(axis).norm(), pitch)
+        self.eye = self.target + offset
+        return self
+
+def default_camera():
+    # looks from E through the centre of the fixed screen rt3 had before
+    # cameras, at the middle of the scene it orbits around
+    return Camera(E, vec3(0, .05, 2))
+
+# Directions of primary rays by camera pose, image size and pixel box, the
+# least recently used first, and their size in bytes
+ray_cache = OrderedDict()
+ray_cache_bytes = 0
+
+def primary_rays(camera, w, h, x0, y0, x1, y1, step = 1, cache = RAY_CACHE_BYTES):
+    # Origin and (3, ny, nx) directions of the rays through every step-th
+    # pixel of [y0:y1, x0:x1] of a w x h image, starting at x0, y0. They are
+    # kept while they fit into cache bytes, for the progressive levels and
+    # later frames of an unchanged view, and are read-only, raytrace never
+    # changes them.
+    global ray_cache_bytes
+    key = (camera.pose(), vec3.dtype, w, h, x0, y0, x1, y1, step)
+    if key in ray_cache:
+        ray_cache.move_to_end(key)
+        return cast(camera.eye), ray_cache[key]
+    xs, ys = camera.screen(w, h)
+    (xs, ys) = (xs[x0:x1:step], ys[y0:y1:step])
+    (O, D) = camera.rays(np.tile(xs, len(ys)), np.repeat(ys, len(xs)))
+    D = D.a.reshape(3, len(ys), len(xs))
+    D.flags.writeable = False
+    if D.nbytes <= cache:
+        ray_cache[key] = D
+        ray_cache_bytes += D.nbytes
+    while ray_cache_bytes > cache:
+        ray_cache_bytes -= ray_cache.popitem(last=False)[1].nbytes
+    return O, D
+
+def to_rgb8(color):
+    # The (3, n) components of the n colours scaled to 0..255 in place, to be
+    # cast straight into uint8 pixels by the caller, without temporaries
+    np.clip(color.a, 0, 1, out=color.a)
+    color.a *= 255
+    return color.a
+
+def trace_tile(scene, camera, fb, x0, y0, x1, y1, step = 1, refine = False, cache = RAY_CACHE_BYTES, **options):
+    # Traces the pixels [y0:y1, x0:x1] of the framebuffer fb on a grid of the
+    # given step, filling each step x step block with its sample. With refine
+    # the samples of the previous, twice as coarse grid are kept, not retraced.
+    # The first hits of the samples go to the G-buffer of fb, or are shaded
+    # from it if it holds all of them (see SharedFramebuffer.hits), without
+    # a G-buffer only their ids are kept. cache bounds the primary ray
+    # directions kept (see primary_rays).
+    # options are passed on to raytrace (max_bounce, min_weight, roulette).
+    gx = np.arange(x0 // step * step, x1, step)
+    gy = np.arange(y0 // step * step, y1, step)
+    new = np.ones((len(gy), len(gx)), dtype=bool)
+    if refine:
+        new = (gy[:, np.newaxis] % (2 * step) != 0) | (gx % (2 * step) != 0)
+    (iy, ix) = np.nonzero(new)
+    if len(ix):
+        (O, D) = primary_rays(camera, fb.w, fb.h, gx[0], gy[0], x1, y1, step, cache)
+        if step == 1 and len(ix) == D[0].size:
+            (D, pixels) = (vec3(D.reshape(3, -1)), np.s_[y0:y1, x0:x1])
+        else:
+            (D, pixels) = (vec3(D[:, iy, ix]), (gy[iy], gx[ix]))
+        gbuffer = fb.hits(pixels)
+        color = raytrace(O, D, scene, gbuffer=gbuffer, ids_only=fb.valid is None, **options)
+        fb.store(pixels, gbuffer)
+    t = time.perf_counter()
+    if step == 1:
+        # the samples are the pixels, quantized straight into the framebuffer
+        tile = fb.image()[y0:y1, x0:x1]
+        if len(ix) == new.size:
+            np.copyto(tile, to_rgb8(color).reshape(3, y1 - y0, x1 - x0).transpose(1, 2, 0), casting='unsafe')
+        elif len(ix):
+            tile[iy, ix] = to_rgb8(color).T
+    else:
+        grid = np.empty((len(gy), len(gx), 3), dtype=np.uint8)
+        grid[~new] = fb.image()[np.ix_(gy, gx)][~new]
+        if len(ix):
+            grid[new] = to_rgb8(color).T
+        block = np.repeat(np.repeat(grid, step, axis=0), step, axis=1)
+        fb.write(x0, y0, x1, y1, block[y0 - gy[0]:y1 - gy[0], x0 - gx[0]:x1 - gx[0]])
+    timed("image", t, (x1 - x0) * (y1 - y0))
+
+def bands(w, h, step = 1, budget = MEMORY_BUDGET):
+    # Yields full width row bands (x0, y0, x1, y1) of the image whose rays
+    # fit into budget bytes, each starting on the sample grid of step
+    rows = max(1, budget // RAY_BYTES // -(-w // step)) * step
+    for y0 in range(0, h, rows):
+        yield (0, y0, w, min(y0 + rows, h))
 
-    #TODO this needs work
+def pixel_chunks(pixels, samples, budget = MEMORY_BUDGET):
+    # Yields runs of pixels whose samples rays each fit into budget bytes
+    size = max(1, budget // RAY_BYTES // samples)
+    for i in range(0, len(pixels), size):
+        yield pixels[i:i + size]
 
-    if self.p or self.n:
-        for OBJECT in scene:
-            if p:
-              OBJECT.c.x = OBJECT.c.x + np.pi / 10
-            if n:
-                OBJECT.c.x = OBJECT.c.x - np.pi / 10
+def pixel_rows(fb, pixels):
+    # The full width box of the rows the (sorted) flat pixel indices are in
+    return (0, pixels[0] // fb.w, fb.w, pixels[-1] // fb.w + 1)
 
-    r = float(w) / h
-    # Screen coordinates: x0, y0, x1, y1.
-    S = (-1, 1 / r + .25, 1, -1 / r + .25)
-    x = np.tile(np.linspace(S[0], S[2], w), h)
-    y = np.repeat(np.linspace(S[1], S[3], h), w)
+def edge_pixels(fb, threshold = AA_THRESHOLD):
+    # Flat indices of the pixels whose 8-bit luminance differs from a
+    # neighbour by more than threshold or that show another object
+    luminance = fb.image() @ np.array([.299, .587, .114])
+    mask = np.zeros((fb.h, fb.w), dtype=bool)
+    for axis in (0, 1):
+        edge = (np.abs(np.diff(luminance, axis=axis)) > threshold) | (np.diff(fb.ids, axis=axis) != 0)
+        (a, b) = ([slice(None)] * 2, [slice(None)] * 2)
+        (a[axis], b[axis]) = (slice(1, None), slice(None, -1))
+        mask[tuple(a)] |= edge
+        mask[tuple(b)] |= edge
+    return np.flatnonzero(mask)
+
+def antialias_pixels(scene, camera, fb, pixels, samples = 4, **options):
+    # Averages the pixel centre already in fb with samples extra rays spread
+    # over the pixel area: a Hammersley point set shifted per pixel by the R2
+    # sequence of its index, so tiles agree however the pixels are split.
+    # pixels are flat indices into the image.
+    xs, ys = camera.screen(fb.w, fb.h)
+    (dx, dy) = (xs[1] - xs[0] if fb.w > 1 else 0, ys[1] - ys[0] if fb.h > 1 else 0)
+    (py, px) = np.divmod(pixels, fb.w)
+    i = np.arange(samples)
+    hx = (i + .5) / samples
+    hy = sum(((i >> bit) & 1) / 2.0 ** (bit + 1) for bit in range(max(1, samples.bit_length())))
+    jx = (hx + pixels[:, np.newaxis] * 0.7548776662466927) % 1 - .5
+    jy = (hy + pixels[:, np.newaxis] * 0.5698402909980532) % 1 - .5
+    (O, D) = camera.rays((xs[px][:, np.newaxis] + jx * dx).ravel(), (ys[py][:, np.newaxis] + jy * dy).ravel())
+    color = raytrace(O, D, scene, **options)
+    sub = np.clip(color.a, 0, 1).reshape(3, len(pixels), samples).sum(axis=-1)
+    t = time.perf_counter()
+    image = fb.image()
+    centre = image[py, px].T / 255
+    image[py, px] = (255 * ((centre + sub) / (samples + 1)).T).astype(np.uint8)
+    timed("image", t, len(pixels))
+
+class SharedFramebuffer:
+    # RGB uint8 framebuffer in shared memory that tile workers write in place.
+    # Rows are stored bottom-up (OpenGL order) so the buffer can be uploaded
+    # to a texture as is; image() is the top-down view of it. ids holds the
+    # object hit first per pixel, top-down, in the same segment. With a float
+    # dtype the segment also holds a G-buffer of these first hits: distance,
+    # position and normal, and which pixels it is valid for. Only the
+    # process that created the segment unlinks it, tile workers just attach.
+    def __init__(self, w, h, name = None, dtype = None):
+        (self.w, self.h) = (w, h)
+        self.dtype = dtype
+        self.owner = name is None
+        self.view = None        # camera pose and scene the G-buffer belongs to
+        layout = [("pixels", (h, w, 3), np.uint8), ("ids", (h, w), np.int32)]
+        if dtype is not None:
+            layout += [("valid", (h, w), np.bool_), ("distance", (h, w), dtype),
+                       ("position", (3, h, w), dtype), ("normal", (3, h, w), dtype)]
+        offsets = [0]
+        for (_, shape, t) in layout:
+            offsets.append((offsets[-1] + int(np.prod(shape)) * np.dtype(t).itemsize + 7) // 8 * 8)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=max(8, offsets[-1]))
+        self.valid = None
+        for ((field, shape, t), offset) in zip(layout, offsets):
+            setattr(self, field, np.ndarray(shape, dtype=t, buffer=self.shm.buf, offset=offset))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def handle(self):
+        # what tile workers need to attach to the segment
+        return (self.name, self.w, self.h, self.dtype)
+
+    def write(self, x0, y0, x1, y1, pixels):
+        # pixels is the top-down (y1 - y0, x1 - x0, 3) block of the tile
+        self.pixels[self.h - y1:self.h - y0, x0:x1] = pixels[::-1]
+
+    def image(self):
+        return self.pixels[::-1]
+
+    def hits(self, pixels):
+        # G-buffer entries for raytrace of the pixels, an index into (h, w)
+        # arrays (slices or index arrays), empty unless all of them are valid
+        if self.valid is None or not self.valid[pixels].all():
+            return {}
+        vectors = (slice(None),) + pixels
+        return {"ids": self.ids[pixels].ravel(), "distance": self.distance[pixels].ravel(),
+                "position": self.position[vectors].reshape(3, -1), "normal": self.normal[vectors].reshape(3, -1)}
+
+    def store(self, pixels, gbuffer):
+        # Records the first hits raytrace left in gbuffer for the pixels
+        shape = self.ids[pixels].shape
+        self.ids[pixels] = gbuffer["ids"].reshape(shape)
+        if self.valid is not None:
+            vectors = (slice(None),) + pixels
+            self.distance[pixels] = gbuffer["distance"].reshape(shape)
+            self.position[vectors] = gbuffer["position"].reshape((3,) + shape)
+            self.normal[vectors] = gbuffer["normal"].reshape((3,) + shape)
+            self.valid[pixels] = True
+
+    def invalidate(self, view):
+        # Forgets the G-buffer unless it was recorded for view, see main_scene
+        if self.valid is not None and not (self.view is not None and self.view[0] == view[0]
+                                           and self.view[1] is view[1]):
+            self.valid[:] = False
+        self.view = view
+
+    def close(self):
+        self.pixels = self.ids = self.valid = self.distance = self.position = self.normal = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass        # views handed out are still alive, the mapping goes with them
+        if self.owner:
+            self.shm.unlink()
+            self.owner = False
+
+framebuffer = None
+
+def shared_framebuffer(w, h, dtype = None):
+    # Returns the shared framebuffer, reallocated when the size or the dtype
+    # of its G-buffer (None: without one) changed
+    global framebuffer
+    if framebuffer is None or (framebuffer.w, framebuffer.h, framebuffer.dtype) != (w, h, dtype):
+        if framebuffer is not None:
+            framebuffer.close()
+        framebuffer = SharedFramebuffer(w, h, dtype=dtype)
+    return framebuffer
+
+@atexit.register
+def release_framebuffer():
+    if framebuffer is not None:
+        framebuffer.close()
+
+# Scene of a tile worker process, handed over once when the pool starts,
+# the framebuffer it is currently attached to and the shading table with the
+# version last applied to the scene
+tile_scene = None
+tile_framebuffer = None
+tile_shading = None
+
+def init_tile_worker(scene, dtype, shading_name):
+    global tile_scene, tile_shading, rng
+    vec3.dtype = dtype
+    tile_scene = scene
+    tile_shading = (shared_memory.SharedMemory(name=shading_name), 0)
+    rng = np.random.default_rng()   # forked workers would share the parent's stream
+
+def shading(scene):
+    # The light and the materials of the objects, edits of which need no
+    # new BVH or tile pool, as a table: row 0 is L, then one row of diffuse
+    # colour and mirror factor per object
+    table = np.zeros((len(scene.objects) + 1, 4))
+    table[0, :3] = L.a.ravel()
+    for (row, s) in zip(table[1:], scene.objects):
+        (row[:3], row[3]) = (s.diffuse.a.ravel(), s.mirror)
+    return table
+
+def apply_shading(scene, table):
+    global L
+    L = vec3(*table[0, :3], dtype=np.float64)
+    for (s, row) in zip(scene.objects, table[1:]):
+        (s.diffuse, s.mirror) = (vec3(*row[:3]), float(row[3]))
+
+def sync_shading():
+    # Applies the shading table the pool published, if it changed since
+    global tile_shading
+    (shm, applied) = tile_shading
+    version = int(np.ndarray(1, dtype=np.int64, buffer=shm.buf)[0])
+    if version != applied:
+        n = len(tile_scene.objects) + 1
+        apply_shading(tile_scene, np.ndarray((n, 4), buffer=shm.buf, offset=8))
+        tile_shading = (shm, version)
+
+def attach_framebuffer(handle):
+    global tile_framebuffer
+    (name, w, h, dtype) = handle
+    if tile_framebuffer is None or tile_framebuffer.name != name:
+        if tile_framebuffer is not None:
+            tile_framebuffer.close()
+        tile_framebuffer = SharedFramebuffer(w, h, name, dtype)
+    return tile_framebuffer
+
+def counted(work, *args, **options):
+    # Runs work in a tile worker and returns its stats
+    reset_stats()
+    work(*args, **options)
+    return dict(stats)
+
+def render_tile(handle, camera, box, step, refine, options):
+    sync_shading()
+    return counted(trace_tile, tile_scene, camera, attach_framebuffer(handle), *box, step, refine, **options)
+
+def antialias_tile(handle, camera, pixels, samples, options):
+    sync_shading()
+    return counted(antialias_pixels, tile_scene, camera, attach_framebuffer(handle), pixels, samples, **options)
+
+class TilePool:
+    # Process pool that renders screen tiles in parallel. The scene is sent
+    # to every worker once at pool start, tiles only carry their pixel box
+    # and the workers write their pixels straight into the shared framebuffer.
+    # The light and the materials, which may change between frames, are
+    # published in a shared segment: a version number and the shading()
+    # table, rewritten only when it changed (see publish and sync_shading).
+    def __init__(self, scene, workers):
+        self.scene = scene
+        self.workers = workers
+        self.table = shading(scene)
+        self.shm = shared_memory.SharedMemory(create=True, size=8 + self.table.nbytes)
+        np.ndarray(1, dtype=np.int64, buffer=self.shm.buf)[0] = 1
+        np.ndarray(self.table.shape, buffer=self.shm.buf, offset=8)[...] = self.table
+        self.executor = ProcessPoolExecutor(workers, initializer=init_tile_worker,
+                                            initargs=(scene, vec3.dtype, self.shm.name))
+
+    def publish(self):
+        # Called before jobs are submitted, no worker reads the segment then
+        table = shading(self.scene)
+        if not np.array_equal(table, self.table):
+            self.table = table
+            np.ndarray(table.shape, buffer=self.shm.buf, offset=8)[...] = table
+            np.ndarray(1, dtype=np.int64, buffer=self.shm.buf)[0] += 1
+
+    def tiles(self, w, h, tile):
+        return [(x0, y0, min(x0 + tile, w), min(y0 + tile, h))
+                for y0 in range(0, h, tile) for x0 in range(0, w, tile)]
+
+    def render(self, fb, camera, tile = 64, step = 1, refine = False, regions = None, **options):
+        # regions(image, box) is called with the box of every tile done, in
+        # the order they finish
+        self.publish()
+        jobs = {self.executor.submit(render_tile, fb.handle(), camera, box, step, refine, options): box
+                for box in self.tiles(fb.w, fb.h, tile)}
+        for job in as_completed(jobs):
+            add_stats(job.result())
+            if regions is not None:
+                regions(fb.image(), jobs[job])
+        return fb.image()
+
+    def antialias(self, fb, camera, pixels, samples = 4, memory = MEMORY_BUDGET, regions = None, **options):
+        if not len(pixels):
+            return fb.image()
+        # at least 4 chunks per worker, each within the memory budget
+        count = max(4 * self.workers, -(-len(pixels) * samples * RAY_BYTES // memory))
+        chunks = np.array_split(pixels, min(len(pixels), count))
+        self.publish()
+        jobs = {self.executor.submit(antialias_tile, fb.handle(), camera, chunk, samples, options): chunk
+                for chunk in chunks if len(chunk)}
+        for job in as_completed(jobs):
+            add_stats(job.result())
+            if regions is not None:
+                regions(fb.image(), pixel_rows(fb, jobs[job]))
+        return fb.image()
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.shm.close()
+        self.shm.unlink()
+
+pool = None
+
+def tile_pool(workers):
+    # Returns the shared pool, restarted when the scene or worker count changed
+    global pool
+    if pool is None or pool.scene is not accel or pool.workers != workers:
+        if pool is not None:
+            pool.shutdown()
+        pool = TilePool(accel, workers)
+    return pool
+
+@atexit.register
+def release_pool():
+    # Stops the tile workers, the next tile_pool() starts new ones
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+def main_scene(self, w, h, camera=None, workers=1, tile=64, step=1, refine=False, antialias=0, memory=MEMORY_BUDGET,
+               gbuffer=True, regions=None, **options):
+    # workers > 1 renders tile x tile pixel blocks in that many processes.
+    # step > 1 traces every step-th pixel only, refine keeps the samples of a
+    # previous render with twice the step (see trace_tile). antialias > 0
+    # adds that many jittered samples to the edge pixels of full resolution
+    # renders. Without workers the image is traced in row bands whose rays
+    # fit into memory bytes and written to the framebuffer band by band, so
+    # peak memory does not grow with the resolution (tiles are small anyway).
+    # Primary ray directions of unchanged views are kept in up to a quarter
+    # of memory (at most RAY_CACHE_BYTES), see primary_rays.
+    # options go to raytrace (max_bounce, min_weight, roulette).
+    # camera defaults to default_camera(), the scene is left as it is.
+    # With gbuffer the first hits are kept in the framebuffer: while the
+    # camera and the geometry (the BVH) stay the same, changes of L or of
+    # materials only trace shadow and reflection rays. It takes 3 ids and 7
+    # floats per pixel though, turn it off when every frame moves the camera.
+    # regions(image, box) is called with every (x0, y0, x1, y1) block of the
+    # image as soon as it is written, so it can be shown before the frame is
+    # done; boxes may be reported again when antialiasing changes them.
+    # Returns a top-down view of the shared framebuffer, which is reused.
+    self.w = w
+    self.h = h
+    camera = default_camera() if camera is None else camera
 
     t0 = time.time()
-    Q = vec3(x, y, 0)
-    color = raytrace(E, (Q - E).norm(), scene)
+    cache = min(RAY_CACHE_BYTES, memory // 4)
+    fb = shared_framebuffer(w, h, vec3.dtype if gbuffer else None)
+    fb.invalidate((camera.pose(), accel))
+    if workers > 1:
+        image = tile_pool(workers).render(fb, camera, tile, step, refine, regions, cache=cache, **options)
+    else:
+        image = fb.image()
+        for box in bands(w, h, step, memory):
+            trace_tile(accel, camera, fb, *box, step, refine, cache, **options)
+            if regions is not None:
+                regions(image, box)
+    if antialias and step == 1:
+        t = time.perf_counter()
+        pixels = edge_pixels(fb)
+        timed("antialias", t, len(pixels))
+        if workers > 1:
+            image = tile_pool(workers).antialias(fb, camera, pixels, antialias, memory, regions, **options)
+        else:
+            for chunk in pixel_chunks(pixels, antialias, memory):
+                antialias_pixels(accel, camera, fb, chunk, antialias, **options)
+                if regions is not None:
+                    regions(image, pixel_rows(fb, chunk))
     print("Took", time.time() - t0)
 
-    rgb = [Image.fromarray((255 * np.clip(c, 0, 1).reshape((h, w))).astype(np.uint8), "L") for c in color.components()]
-    im = Image.merge("RGB", rgb)
-
-    return np.array(im)
+    return image
 
 
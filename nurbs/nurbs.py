@@ -320,6 +320,12 @@ class RenderWindow:
         glfw.set_mouse_button_callback(self.window, self.onMouseButton)
         glfw.set_key_callback(self.window, self.onKeyboard)
         glfw.set_window_size_callback(self.window, self.onSize)
+        glfw.set_cursor_pos_callback(self.window, self.onMouseMove)
+        glfw.set_window_refresh_callback(self.window, lambda win: self.invalidate())
+
+        # imgui handles text and scroll input itself, it needs redraws too
+        for set_callback in (glfw.set_char_callback, glfw.set_scroll_callback):
+            self.chain(set_callback)
 
         # create modernGL context and initialize GL objects in scene
         self.ctx = mgl.create_context()
@@ -330,7 +336,27 @@ class RenderWindow:
         # exit flag
         self.exitNow = False
 
+        # frames still to redraw, see invalidate(), and how long an idle
+        # window sleeps at most before looking for work again
+        self.redraw         = 1
+        self.idle_timeout   = 0.5
+
+    def chain(self, set_callback):
+        # Installs a callback that marks the window dirty before calling the
+        # one set before (imgui's)
+        previous = set_callback(self.window, None)
+        def callback(*args):
+            self.invalidate()
+            if previous is not None:
+                previous(*args)
+        set_callback(self.window, callback)
+
+    def invalidate(self, frames=3):
+        # Redraws the next frames, imgui takes a few to show the effect of input
+        self.redraw = max(self.redraw, frames)
+
     def onMouseButton(self, win, button, action, mods):
+        self.invalidate()
         # Don't react to clicks on UI controllers
         # Change the weight by clicking on the point (is working)
         """
@@ -370,10 +396,18 @@ class RenderWindow:
                 glfw.set_cursor_pos_callback(win, self.on_mouse_move)
             if action == glfw.RELEASE:
                 self.scene.rise = False
+                glfw.set_cursor_pos_callback(win, self.onMouseMove)
+
+
+
+    def onMouseMove(self, win, x, y):
+        # hovering changes the UI
+        self.invalidate()
 
 
 
     def on_mouse_move(self, win, x, y):
+        self.invalidate()
         p = [int(x), int(y)]
         radius = 30
         found_point = False
@@ -393,6 +427,7 @@ class RenderWindow:
 
     def onKeyboard(self, win, key, scancode, action, mods):
         #print("keyboard: ", win, key, scancode, action, mods)
+        self.invalidate()
 
         if action == glfw.PRESS:
             # ESC to quit
@@ -434,41 +469,51 @@ class RenderWindow:
         self.height         = height
         self.ctx.viewport   = (0, 0, self.width, self.height)
         self.scene.resize(width, height)
+        self.invalidate()
 
 
     def run(self):
-        # initializer timer
+        # Event-driven main loop: sleeps in wait_events_timeout until input
+        # needs a redraw, at most frame_rate redraws per second
         glfw.set_time(0.0)
-        t = 0.0
+        t = -1.0
         while not glfw.window_should_close(self.window) and not self.exitNow:
-            # update every x seconds
+            if self.redraw > 0:
+                wait = t + 1.0 / self.frame_rate - glfw.get_time()
+            else:
+                wait = self.idle_timeout
+            if wait > 0:
+                glfw.wait_events_timeout(wait)  # Wait for GLFW events
+            else:
+                glfw.poll_events()              # Poll for GLFW events
+
             currT = glfw.get_time()
-            if currT - t > 1.0 / self.frame_rate:
-                # update time
-                t = currT
-
-                # == Frame-wise IMGUI Setup ===
-                imgui.new_frame()                   # Start new frame context
-                imgui.begin("Controller")     # Start new window context
-
-                # Define UI Elements
-                if imgui.button("Clear (C)"):
-                    self.scene.clear()
-
-                if imgui.button("Show Spline (S)"):
-                    self.scene.show_spline = not self.scene.show_spline
-
-                imgui.end()                         # End window context
-                imgui.render()                      # Run render callback
-                imgui.end_frame()                   # End frame context
-                self.impl.process_inputs()          # Poll for UI events
-
-                # == Rendering GL ===
-                glfw.poll_events()                  # Poll for GLFW events
-                self.ctx.clear()                    # clear viewport
-                self.scene.render()                 # render scene
-                self.impl.render(imgui.get_draw_data()) # render UI
-                glfw.swap_buffers(self.window)      # swap front and back buffer
+            if self.redraw == 0 or currT - t < 1.0 / self.frame_rate:
+                continue
+            t = currT
+            self.redraw = max(0, self.redraw - 1)
+
+            # == Frame-wise IMGUI Setup ===
+            imgui.new_frame()                   # Start new frame context
+            imgui.begin("Controller")     # Start new window context
+
+            # Define UI Elements
+            if imgui.button("Clear (C)"):
+                self.scene.clear()
+
+            if imgui.button("Show Spline (S)"):
+                self.scene.show_spline = not self.scene.show_spline
+
+            imgui.end()                         # End window context
+            imgui.render()                      # Run render callback
+            imgui.end_frame()                   # End frame context
+            self.impl.process_inputs()          # Poll for UI events
+
+            # == Rendering GL ===
+            self.ctx.clear()                    # clear viewport
+            self.scene.render()                 # render scene
+            self.impl.render(imgui.get_draw_data()) # render UI
+            glfw.swap_buffers(self.window)      # swap front and back buffer
 
 
         # end